@@ -1,14 +1,17 @@
 # src/discover.py
 import sys
-import re
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urljoin, urlparse
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import feedparser
+from selectolax.parser import HTMLParser
 
 ROOT = Path(__file__).resolve().parents[1]
 CFG_FEEDS = ROOT / "config" / "feed.yaml"
@@ -16,12 +19,25 @@ CFG_DISC = ROOT / "config" / "discovery.yaml"
 
 UA = "ai-news-discover/1.0 (+https://example.local)"
 TIMEOUT = 10
+HTML_MAX_BYTES = 200_000
 
-LINK_RE = re.compile(
-    r'<link[^>]+rel=["\']alternate["\'][^>]+type=["\'](application/(rss\+xml|atom\+xml))["\'][^>]*>',
-    re.IGNORECASE,
-)
-HREF_RE = re.compile(r'href=["\']([^"\']+)["\']', re.IGNORECASE)
+FEED_TYPES = {"application/rss+xml", "application/atom+xml"}
+FEED_CONTENT_TYPES = ("application/rss+xml", "application/atom+xml", "text/xml", "application/xml")
+PROBE_MAX_BYTES = 4 * 1024
+XML_SNIFF_BYTES = 256
+PROBE_WORKERS = 4
+
+def make_session():
+    # одна сессия на весь прогон: keep-alive и пул соединений вместо TLS-рукопожатия на каждый запрос
+    session = requests.Session()
+    session.headers["User-Agent"] = UA
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                          max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = make_session()
 
 def load_yaml(path, required=True):
     if not path.exists():
@@ -37,10 +53,15 @@ def save_yaml(path, data):
         yaml.safe_dump(data, f, allow_unicode=True, sort_keys=False)
 
 def get_html(url):
-    r = requests.get(url, headers={"User-Agent": UA}, timeout=TIMEOUT)
-    r.raise_for_status()
-    # Только head и верх страницы нужны для discovery
-    return r.text[:200_000]
+    # Только head и верх страницы нужны для discovery — дальше тело не качаем
+    headers = {
+        "Accept-Encoding": "gzip, deflate",
+        "Range": f"bytes=0-{HTML_MAX_BYTES - 1}",
+    }
+    with SESSION.get(url, headers=headers, timeout=TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        raw = r.raw.read(HTML_MAX_BYTES, decode_content=True)
+        return raw.decode(r.encoding or "utf-8", errors="replace")
 
 def discover_in_head(url):
     """
@@ -52,44 +73,54 @@ def discover_in_head(url):
         return []
     base = url
     found = []
-    for tag in LINK_RE.findall(html):
-        # LINK_RE матчится на тег, но нам нужен href из тега целиком.
-        # Переберём все совпадения линков повторно по блоку head:
-        pass  
-    # Ищем все <link ...> и фильтруем по type
-    tags = re.findall(r"<link[^>]+>", html, flags=re.IGNORECASE)
-    for t in tags:
-        if re.search(r'rel=["\']alternate["\']', t, flags=re.IGNORECASE) and \
-           re.search(r'type=["\']application/(rss\+xml|atom\+xml)["\']', t, flags=re.IGNORECASE):
-            m = HREF_RE.search(t)
-            if m:
-                href = m.group(1).strip()
-                abs_url = urljoin(base, href)
-                found.append(abs_url)
+    for node in HTMLParser(html).css("link[rel]"):
+        attrs = node.attributes
+        if "alternate" not in (attrs.get("rel") or "").lower().split():
+            continue
+        if (attrs.get("type") or "").strip().lower() not in FEED_TYPES:
+            continue
+        href = (attrs.get("href") or "").strip()
+        if href:
+            found.append(urljoin(base, href))
     return list(dict.fromkeys(found))
 
+def probe_feed_url(test_url):
+    """
+    Проверяет один кандидат: сначала HEAD, начало тела (PROBE_MAX_BYTES)
+    качаем только если по заголовкам непонятно, фид это или нет.
+    """
+    try:
+        r = SESSION.head(test_url, timeout=TIMEOUT, allow_redirects=True)
+        # 405/501 — сервер не умеет HEAD, решаем по GET
+        if r.status_code not in (405, 501):
+            if not r.ok:
+                return False
+            if r.headers.get("content-type", "").lower().startswith(FEED_CONTENT_TYPES):
+                return True
+        with SESSION.get(test_url, timeout=TIMEOUT, stream=True) as r:
+            if not r.ok:
+                return False
+            if r.headers.get("content-type", "").lower().startswith(FEED_CONTENT_TYPES):
+                return True
+            # даже если content-type общий, посмотрим на начало документа
+            return looks_like_xml(r.raw.read(PROBE_MAX_BYTES, decode_content=True))
+    except Exception:
+        return False
+
 def try_common_paths(base_url, try_paths):
     """
     Пробует типовые пути вроде /feed, /rss.xml. Возвращает существующие.
     """
-    out = []
-    for p in try_paths:
-        test_url = urljoin(base_url.rstrip("/") + "/", p.lstrip("/"))
-        try:
-            r = requests.get(test_url, headers={"User-Agent": UA}, timeout=TIMEOUT)
-            if r.ok and r.headers.get("content-type", "").lower().startswith(("application/rss+xml", "application/atom+xml", "text/xml", "application/xml")):
-                out.append(test_url)
-                continue
-            # даже если content-type общий, попробуем распарсить feedparser'ом
-            if r.ok and looks_like_xml(r.text):
-                out.append(test_url)
-        except Exception:
-            continue
+    test_urls = [urljoin(base_url.rstrip("/") + "/", p.lstrip("/")) for p in try_paths]
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as ex:
+        ok = list(ex.map(probe_feed_url, test_urls))
+    out = [u for u, good in zip(test_urls, ok) if good]
     return list(dict.fromkeys(out))
 
-def looks_like_xml(text):
-    t = text.strip()[:200].lower()
-    return t.startswith("<?xml") or "<rss" in t or "<feed" in t
+def looks_like_xml(data: bytes) -> bool:
+    # смотрим на сырые байты начала ответа — без декодирования всего тела
+    head = data.lstrip(b"\xef\xbb\xbf \t\r\n")[:XML_SNIFF_BYTES].lower()
+    return head.startswith(b"<?xml") or b"<rss" in head or b"<feed" in head
 
 def normalize_home(url):
     """
@@ -107,7 +138,7 @@ def validate_feed(url, min_recent_days=30):
     Возвращает (ok:bool, title:str|None, reason:str|None).
     """
     try:
-        d = feedparser.parse(url)
+        d = feedparser.parse(url, agent=UA, sanitize_html=False, resolve_relative_uris=False)
     except Exception as ex:
         return False, None, f"parse_error: {ex}"
     if not getattr(d, "entries", None):
@@ -139,7 +170,10 @@ def load_feeds_yaml():
     data = load_yaml(CFG_FEEDS, required=False)
     feeds = data.get("feeds", []) if isinstance(data, dict) else []
     win = (data.get("window_hours", 24) if isinstance(data, dict) else 24)
-    return {"window_hours": win, "feeds": feeds}
+    out = {"window_hours": win, "feeds": feeds}
+    if isinstance(data, dict) and "parallel_workers" in data:
+        out["parallel_workers"] = data["parallel_workers"]
+    return out
 
 def add_feeds_to_yaml(new_urls):
     y = load_feeds_yaml()
@@ -1,23 +1,31 @@
 # backend/main.py
 import os
-import json
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from typing import List, Optional, Annotated
 
+import orjson
 from fastapi import FastAPI, Depends, HTTPException, Header
 from pydantic import BaseModel, Field, EmailStr
 
 from sqlalchemy import (
     create_engine, String, Text, Integer, BigInteger, DateTime,
-    ForeignKey, ARRAY, select, func
+    ForeignKey, ARRAY, Index, select, delete, func, exists
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column,
-    relationship, sessionmaker, Session
+    relationship, sessionmaker, Session, selectinload
 )
 
-# Импорт твоей функции: возвращает JSON-строку со списком триплетов [text, url, date]
-from src.ai_news_process import ai_news_process as external_ai_news_process
+# Импорт твоей функции: возвращает (JSON-строку со списком триплетов [text, url, date], обновления кэша лент)
+from src.ai_news_process import (
+    ai_news_process as external_ai_news_process,
+    load_feed_cache, save_feed_cache,
+)
 
 # ---------- Настройки/БД ----------
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+psycopg://app:app_password@db:5432/app")
@@ -63,6 +71,10 @@ class NewsItem(Base):
 
     seen_by: Mapped[List["UserSeenNews"]] = relationship(back_populates="news", cascade="all, delete-orphan")
 
+# индексы под ленту: сортировка по дате и пересечение тегов (&&)
+Index("news_items_published_at_desc", NewsItem.published_at.desc().nullslast())
+Index("news_items_tags_gin", NewsItem.tags, postgresql_using="gin")
+
 class UserSeenNews(Base):
     __tablename__ = "user_seen_news"
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
@@ -102,8 +114,11 @@ class NewsOut(BaseModel):
     class Config:
         from_attributes = True
 
-class RunResponse(BaseModel):
-    items: List[NewsOut]
+class RunStatus(BaseModel):
+    run_id: str
+    status: str  # queued | running | done | error
+    error: Optional[str] = None
+    items: List[NewsOut] = []
 
 # ---------- Авторизация для защищённых ручек ----------
 def require_api_key(x_api_key: Annotated[Optional[str], Header()] = None):
@@ -116,6 +131,9 @@ app = FastAPI(title="News API")
 @app.on_event("startup")
 def on_startup():
     Base.metadata.create_all(bind=engine)
+    # create_all не трогает уже существующие таблицы — индексы докатываем отдельно
+    for index in NewsItem.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # ---- Пользователи ----
 @app.post("/users", response_model=UserOut)
@@ -147,14 +165,17 @@ def set_tags(user_id: int, payload: TagsIn, db: Session = Depends(get_db)):
     user = db.get(User, user_id)
     if not user:
         raise HTTPException(404, "User not found")
-    db.query(UserTag).filter(UserTag.user_id == user_id).delete()
-    for tag in payload.tags:
-        tag = tag.strip().lower()
-        if tag:
-            db.add(UserTag(user_id=user_id, tag=tag))
+    new_tags = {t.strip().lower() for t in payload.tags if t.strip()}
+    # убираем только лишние теги, остальные досыпаем одним INSERT ... ON CONFLICT
+    db.execute(delete(UserTag).where(UserTag.user_id == user_id, ~UserTag.tag.in_(new_tags)))
+    if new_tags:
+        db.execute(
+            pg_insert(UserTag)
+            .values([{"user_id": user_id, "tag": t} for t in new_tags])
+            .on_conflict_do_nothing()
+        )
     db.commit()
-    tags = [t.tag for t in db.query(UserTag).filter_by(user_id=user_id).all()]
-    return TagsOut(user_id=user_id, tags=tags)
+    return TagsOut(user_id=user_id, tags=sorted(new_tags))
 
 # ---- Отметка "просмотрено" ----
 @app.post("/users/{user_id}/seen")
@@ -172,45 +193,48 @@ def mark_seen(user_id: int, payload: SeenIn, db: Session = Depends(get_db)):
     return {"status": "ok"}
 
 # ---- Фид пользователя ----
-@app.get("/users/{user_id}/feed", response_model=List[NewsOut])
-def user_feed(user_id: int, limit: int = 50, db: Session = Depends(get_db)):
-    user = db.get(User, user_id)
+def get_user_with_tags(db: Session, user_id: int) -> User:
+    user = db.scalars(
+        select(User).options(selectinload(User.tags)).where(User.id == user_id)
+    ).one_or_none()
     if not user:
         raise HTTPException(404, "User not found")
+    return user
 
+def filter_for_user(stmt, user: User):
+    """
+    Добавляет к выборке NewsItem фильтры пользователя на стороне БД:
+    без просмотренных и (если теги заданы) с пересечением тегов.
+    """
+    stmt = stmt.where(~exists().where(
+        UserSeenNews.user_id == user.id,
+        UserSeenNews.news_id == NewsItem.id,
+    ))
     user_tags = [t.tag for t in user.tags]
-    seen_ids = set(
-        db.scalars(select(UserSeenNews.news_id).where(UserSeenNews.user_id == user_id)).all()
-    )
+    if user_tags:
+        stmt = stmt.where(NewsItem.tags.op("&&")(user_tags))
+    return stmt
 
+@app.get("/users/{user_id}/feed", response_model=List[NewsOut])
+def user_feed(user_id: int, limit: int = 50, db: Session = Depends(get_db)):
+    user = get_user_with_tags(db, user_id)
     stmt = (
-        select(NewsItem)
-        .where(~NewsItem.id.in_(seen_ids))
+        filter_for_user(select(NewsItem), user)
         .order_by(NewsItem.published_at.desc().nullslast())
         .limit(limit)
     )
-    items = list(db.scalars(stmt).all())
-
-    if user_tags:
-        tagset = set(user_tags)
-        items = [it for it in items if set((it.tags or [])) & tagset]
-    return items
+    return list(db.scalars(stmt).all())
 
 # ---- /run: вызываем твою функцию из src/ai_news_process.py и апсертим в БД ----
-@app.post("/run", response_model=RunResponse, dependencies=[Depends(require_api_key)])
-def run(user_id: Optional[int] = None, db: Session = Depends(get_db)):
-    """
-    1) external_ai_news_process() -> возвращает JSON-строку со списком триплетов [text, url, date].
-    2) Апсерт в news_items по url: сохраняем body=text, published_at=date.
-    3) Если указан user_id — исключаем уже просмотренные и фильтруем по его тегам.
-    """
+def upsert_news(db: Session, feed_cache: dict) -> List[NewsItem]:
     try:
-        output = external_ai_news_process()  # JSON-строка
-        triplets = json.loads(output)
+        output, cache_updates = external_ai_news_process(feed_cache)
+        triplets = orjson.loads(output)
     except Exception as exc:
         raise HTTPException(500, f"ai_news_process error: {exc}")
 
-    stored: List[NewsItem] = []
+    # url -> строка для апсерта; повтор url в одной пачке ON CONFLICT не переживёт
+    rows = {}
     for t in triplets:
         if not isinstance(t, list) or len(t) < 2:
             continue
@@ -225,39 +249,139 @@ def run(user_id: Optional[int] = None, db: Session = Depends(get_db)):
             except Exception:
                 published_at = None
 
-        existing = db.execute(select(NewsItem).where(NewsItem.url == url)).scalar_one_or_none()
-        if existing:
-            existing.body = text
-            if published_at:
-                existing.published_at = published_at
-            db.add(existing)
-            stored.append(existing)
-        else:
-            item = NewsItem(
-                url=url,
-                title=None,
-                body=text,
-                tags=[],  # при желании можно заполнять в будущем
-                published_at=published_at,
-            )
-            db.add(item)
-            db.flush()
-            stored.append(item)
+        rows[url] = {
+            "url": url,
+            "title": None,
+            "body": text,
+            "tags": [],  # при желании можно заполнять в будущем
+            "published_at": published_at,
+        }
 
-    db.commit()
+    stored: List[NewsItem] = []
+    if rows:
+        stmt = pg_insert(NewsItem).values(list(rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[NewsItem.url],
+            set_={
+                "body": stmt.excluded.body,
+                # пустая дата не затирает уже сохранённую
+                "published_at": func.coalesce(stmt.excluded.published_at, NewsItem.published_at),
+            },
+        ).returning(NewsItem.id)
+        ids = db.scalars(stmt).all()
+        db.commit()
+        by_url = {it.url: it for it in db.scalars(select(NewsItem).where(NewsItem.id.in_(ids)))}
+        stored = [by_url[u] for u in rows if u in by_url]
+
+    save_feed_cache({**feed_cache, **cache_updates})
+    return stored
+
+# один прогон за раз: параллельные /run делили бы кэш etag/modified лент
+INGEST_LOCK = threading.Lock()
+
+def ingest_news(db: Session) -> List[NewsItem]:
+    """
+    1) external_ai_news_process() -> возвращает JSON-строку со списком триплетов [text, url, date].
+    2) Апсерт в news_items по url: сохраняем body=text, published_at=date.
+    3) Кэш etag/modified лент сохраняем только после коммита — иначе при сбое
+       следующий прогон получит 304 и записи потеряются.
+    Вызывать под INGEST_LOCK.
+    """
+    feed_cache = load_feed_cache()
+    return upsert_news(db, feed_cache)
 
-    items = stored
-    if user_id is not None:
-        user = db.get(User, user_id)
-        if not user:
-            raise HTTPException(404, "User not found")
-        user_tags = [t.tag for t in user.tags]
-        seen_ids = set(
-            db.scalars(select(UserSeenNews.news_id).where(UserSeenNews.user_id == user_id)).all()
-        )
-        items = [it for it in items if it.id not in seen_ids]
-        if user_tags:
-            tagset = set(user_tags)
-            items = [it for it in items if set((it.tags or [])) & tagset]
+def news_for_user(db: Session, items: List[NewsItem], user_id: Optional[int]) -> List[NewsItem]:
+    """
+    Если указан user_id — исключаем уже просмотренные и фильтруем по его тегам.
+    """
+    if user_id is None:
+        return items
+    user = get_user_with_tags(db, user_id)
+    visible = set(db.scalars(
+        filter_for_user(select(NewsItem.id), user).where(NewsItem.id.in_([it.id for it in items]))
+    ).all())
+    return [it for it in items if it.id in visible]
+
+# Прогон идёт десятки секунд, поэтому /run только ставит задачу в очередь,
+# а результат забирается через GET /run/{run_id}. Храним последние RUN_HISTORY.
+# Очередь разбирает один фоновый воркер: всё, что накопилось, пока шёл прошлый
+# прогон, обслуживается одним общим прогоном, и потоки общего пула не заняты ожиданием.
+RUN_HISTORY = 100
+RUNS: "OrderedDict[str, RunStatus]" = OrderedDict()
+RUNS_LOCK = threading.Lock()
+RUN_QUEUE: Optional[asyncio.Queue] = None
+RUN_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+def set_run_status(status: RunStatus):
+    with RUNS_LOCK:
+        RUNS[status.run_id] = status
+        while len(RUNS) > RUN_HISTORY:
+            RUNS.popitem(last=False)
+
+def get_run_status(run_id: str) -> Optional[RunStatus]:
+    with RUNS_LOCK:
+        return RUNS.get(run_id)
+
+def process_runs(jobs):
+    """
+    Один прогон ingest_news на пачку заявок [(run_id, user_id)], дальше —
+    фильтр под каждого пользователя.
+    """
+    db = SessionLocal()
+    try:
+        with INGEST_LOCK:
+            for run_id, _ in jobs:
+                set_run_status(RunStatus(run_id=run_id, status="running"))
+            try:
+                stored = ingest_news(db)
+            except Exception as exc:
+                error = str(exc.detail) if isinstance(exc, HTTPException) else f"run error: {exc}"
+                for run_id, _ in jobs:
+                    set_run_status(RunStatus(run_id=run_id, status="error", error=error))
+                return
+        for run_id, user_id in jobs:
+            try:
+                items = news_for_user(db, stored, user_id)
+                status = RunStatus(
+                    run_id=run_id, status="done",
+                    items=[NewsOut.model_validate(it) for it in items],
+                )
+            except HTTPException as exc:
+                status = RunStatus(run_id=run_id, status="error", error=str(exc.detail))
+            except Exception as exc:
+                status = RunStatus(run_id=run_id, status="error", error=f"run error: {exc}")
+            set_run_status(status)
+    finally:
+        db.close()
 
-    return RunResponse(items=items)
+async def run_worker():
+    while True:
+        jobs = [await RUN_QUEUE.get()]
+        while not RUN_QUEUE.empty():
+            jobs.append(RUN_QUEUE.get_nowait())
+        # отдельный поток, а не общий пул Starlette — синхронные ручки не ждут прогон
+        await asyncio.to_thread(process_runs, jobs)
+
+@app.on_event("startup")
+async def start_run_worker():
+    global RUN_QUEUE, RUN_LOOP
+    RUN_QUEUE = asyncio.Queue()
+    RUN_LOOP = asyncio.get_running_loop()
+    app.state.run_worker = asyncio.create_task(run_worker())
+
+@app.post("/run", response_model=RunStatus, status_code=202, dependencies=[Depends(require_api_key)])
+def run(user_id: Optional[int] = None, db: Session = Depends(get_db)):
+    if user_id is not None and not db.get(User, user_id):
+        raise HTTPException(404, "User not found")
+    status = RunStatus(run_id=uuid.uuid4().hex, status="queued")
+    set_run_status(status)
+    # ручка синхронная и живёт в потоке пула, а asyncio.Queue не потокобезопасна
+    RUN_LOOP.call_soon_threadsafe(RUN_QUEUE.put_nowait, (status.run_id, user_id))
+    return status
+
+@app.get("/run/{run_id}", response_model=RunStatus, dependencies=[Depends(require_api_key)])
+def run_status(run_id: str):
+    status = get_run_status(run_id)
+    if not status:
+        raise HTTPException(404, "Run not found")
+    return status
@@ -1,16 +1,31 @@
 # src/ai_news_process.py
-# Зависимости: feedparser, trafilatura, pyyaml
-import os, re, json, time, html
+# Зависимости: feedparser, lxml, requests, trafilatura, pyyaml, datasketch, pyahocorasick, mmh3, numpy, orjson
+import os, io, re, json, time, html, threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 from urllib.parse import urlparse
 
 import yaml
 import feedparser
+import mmh3
+import numpy as np
+import orjson
+import requests
 import trafilatura
+from lxml import etree
+from datasketch import MinHash, MinHashLSH
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 ROOT = Path(__file__).resolve().parents[1]
 CFG = ROOT / "config" / "feed.yaml"
+FEED_CACHE = ROOT / "data" / "feed_cache.json"
 
 # --------- настройки ----------
 WINDOW_HOURS_DEFAULT = 24
@@ -22,10 +37,23 @@ AI_KEYWORDS = [
     "artificial intelligence","neural","machine learning","deep learning",
     "large language model","generative","foundation model","llm",
 ]
+# все ключевые слова ищутся за один проход: автоматом Ахо-Корасик,
+# а без pyahocorasick — одной скомпилированной альтернацией
+AI_RE = re.compile("|".join(re.escape(k) for k in AI_KEYWORDS))
+AI_AUTOMATON = None
+if ahocorasick is not None:
+    AI_AUTOMATON = ahocorasick.Automaton()
+    for _kw in AI_KEYWORDS:
+        AI_AUTOMATON.add_word(_kw, _kw)
+    AI_AUTOMATON.make_automaton()
+
 MAX_TEXT_PER_ITEM = 1500
 SIMPLE_DUP_JACCARD = 0.7
+MINHASH_PERM = 128
 HTTP_TIMEOUT = 15
 SLEEP_BETWEEN = 0.2
+PARALLEL_WORKERS_DEFAULT = 8
+feedparser.USER_AGENT = "ai-news-process/1.0 (+https://example.local)"
 
 # ---------- конфиг ----------
 def load_feeds():
@@ -34,107 +62,306 @@ def load_feeds():
     cfg = yaml.safe_load(CFG.read_text(encoding="utf-8")) or {}
     feeds = cfg.get("feeds", [])
     window = int(cfg.get("window_hours", WINDOW_HOURS_DEFAULT))
+    workers = max(1, int(cfg.get("parallel_workers", PARALLEL_WORKERS_DEFAULT)))
     if not feeds:
         raise SystemExit("В config/feeds.yaml пустой список feeds")
-    return feeds, window
+    return feeds, window, workers
+
+TAG_RE = re.compile(r"<[^>]+>")
+WS_RE = re.compile(r"\s+")
 
-def clean_text(t: str) -> str:
-    t = re.sub(r"<[^>]+>", " ", t)
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
+def clean_text(t: str, has_html: bool = True) -> str:
+    if has_html:
+        t = TAG_RE.sub(" ", t)
+    return WS_RE.sub(" ", t).strip()
 
 def is_ai_related(text: str) -> bool:
     t = text.lower()
-    return any(k in t for k in AI_KEYWORDS)
+    if AI_AUTOMATON is None:
+        return AI_RE.search(t) is not None
+    return next(AI_AUTOMATON.iter(t), None) is not None
 
 # ---------- загрузка из RSS ----------
-def fetch_entries(feeds, window_hours):
-    cutoff = datetime.now(timezone.utc) - timedelta(hours=window_hours)
-    items = []
-    for url in feeds:
+def load_feed_cache():
+    try:
+        return json.loads(FEED_CACHE.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+def save_feed_cache(cache):
+    # пишем во временный файл и подменяем атомарно — без полузаписанного JSON
+    FEED_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = FEED_CACHE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, FEED_CACHE)
+
+# только RSS 2.0 (без namespace), RSS 1.0 и Atom: {*} цеплял бы и media:title,
+# itunes:summary, atom:link и прочие расширения
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+RSS1_NS = "{http://purl.org/rss/1.0/}"
+DC_NS = "{http://purl.org/dc/elements/1.1/}"
+FEED_ITEM_TAGS = ("item", RSS1_NS + "item", ATOM_NS + "entry")
+FEED_TITLE_TAGS = ("title", RSS1_NS + "title", ATOM_NS + "title")
+FEED_LINK_TAGS = ("link", RSS1_NS + "link", ATOM_NS + "link")
+FEED_SUMMARY_TAGS = ("description", RSS1_NS + "description", ATOM_NS + "summary", ATOM_NS + "content")
+FEED_DATE_TAGS = ("pubDate", ATOM_NS + "published", ATOM_NS + "updated", DC_NS + "date")
+
+def parse_date(s):
+    # RSS — RFC 822, Atom и dc:date — ISO 8601
+    if not s:
+        return None
+    s = s.strip()
+    try:
+        dt = parsedate_to_datetime(s)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def _first_text(el, tags):
+    # itertext, а не findtext: у Atom type="xhtml" текст лежит во вложенном <div>
+    for tag in tags:
+        node = el.find(tag)
+        if node is None:
+            continue
+        txt = "".join(node.itertext())
+        if txt.strip():
+            return txt
+    return ""
+
+def _entry_link(el):
+    for link in el:
+        if link.tag not in FEED_LINK_TAGS:
+            continue
+        href = link.get("href")
+        if href is None and link.text and link.text.strip():
+            return link.text   # RSS: <link>url</link>
+        if href and link.get("rel", "alternate") == "alternate":
+            return href        # Atom: <link rel="alternate" href="url"/>
+    return None
+
+def parse_entries_lxml(content: bytes):
+    """
+    Быстрый разбор RSS/Atom на lxml: берём только title/link/summary/дату.
+    """
+    entries = []
+    # лента недоверенная: никаких внешних сущностей и DTD (XXE)
+    events = etree.iterparse(
+        io.BytesIO(content), events=("end",), tag=FEED_ITEM_TAGS,
+        resolve_entities=False, no_network=True, load_dtd=False,
+    )
+    for _, el in events:
+        dt = None
+        for tag in FEED_DATE_TAGS:
+            dt = parse_date(el.findtext(tag))
+            if dt:
+                break
+        entries.append({
+            "title": _first_text(el, FEED_TITLE_TAGS),
+            "link": _entry_link(el),
+            "summary": _first_text(el, FEED_SUMMARY_TAGS),
+            "dt": dt,
+        })
+        el.clear()
+    return entries
+
+def parse_entries_feedparser(content: bytes, headers=None):
+    entries = []
+    # нужны только title/link/summary/дата: санитайзинг HTML и резолв ссылок
+    # внутри summary — лишний проход html.parser, теги потом снимает clean_text.
+    # HTTP-заголовки передаём ради charset из Content-Type (windows-1251 и т.п.)
+    # feedparser ищет ключи в нижнем регистре, а requests отдаёт их как прислал сервер
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    d = feedparser.parse(content, response_headers=headers, sanitize_html=False,
+                         resolve_relative_uris=False)
+    for e in d.entries:
+        dt = None
+        for attr in ("published_parsed", "updated_parsed"):
+            if hasattr(e, attr) and getattr(e, attr):
+                try:
+                    dt = datetime(*getattr(e, attr)[:6], tzinfo=timezone.utc)
+                    break
+                except Exception:
+                    pass
+        entries.append({
+            "title": getattr(e, "title", "") or "",
+            "link": getattr(e, "link", None),
+            "summary": getattr(e, "summary", "") or "",
+            "dt": dt,
+        })
+    return entries
+
+def parse_feed(url, cached=None):
+    """
+    Скачивает ленту условным GET'ом (неизменившаяся отвечает 304 без тела)
+    и разбирает её. Возвращает None при ошибке, иначе dict со status,
+    etag, modified и entries.
+    """
+    cached = cached or {}
+    headers = {"User-Agent": feedparser.USER_AGENT}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("modified"):
+        headers["If-Modified-Since"] = cached["modified"]
+    try:
+        r = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        if r.status_code == 304:
+            return {"status": 304, "etag": None, "modified": None, "entries": []}
+        r.raise_for_status()
         try:
-            d = feedparser.parse(url)
+            entries = parse_entries_lxml(r.content)
         except Exception:
+            entries = None
+        if not entries:
+            # битый или нестандартный XML — feedparser прощает больше
+            entries = parse_entries_feedparser(r.content, r.headers)
+    except Exception:
+        return None
+    return {
+        "status": r.status_code,
+        "etag": r.headers.get("ETag"),
+        "modified": r.headers.get("Last-Modified"),
+        "entries": entries,
+    }
+
+def fetch_entries(feeds, window_hours, workers=PARALLEL_WORKERS_DEFAULT, cache=None):
+    """
+    cache — {url: {etag, modified}} для условного GET, None — качаем всё.
+    Возвращает (items, cache_updates). Новые etag/modified сохраняет вызывающий
+    и только после того, как записи надёжно сохранены, иначе следующий прогон
+    получит 304 и потеряет их.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=window_hours)
+    items = []
+    cache = cache or {}
+    cache_updates = {}
+    # скачиваем ленты параллельно (IO-bound), разбор записей — последовательно
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        parsed = list(ex.map(parse_feed, feeds, [cache.get(url) for url in feeds]))
+    for url, d in zip(feeds, parsed):
+        if d is None or d["status"] == 304:
             continue
-        entries = getattr(d, "entries", []) or []
-        for e in entries:
-            link = getattr(e, "link", None)
-            title = getattr(e, "title", "") or ""
+        if d["etag"] or d["modified"]:
+            cache_updates[url] = {"etag": d["etag"], "modified": d["modified"]}
+        for e in d["entries"]:
+            link = e["link"]
+            title = e["title"]
             if not link or not title:
                 continue
-            # дата
-            dt = None
-            for attr in ("published_parsed", "updated_parsed"):
-                if hasattr(e, attr) and getattr(e, attr):
-                    try:
-                        dt = datetime(*getattr(e, attr)[:6], tzinfo=timezone.utc)
-                        break
-                    except Exception:
-                        pass
+            dt = e["dt"]
             if dt and dt < cutoff:
                 continue
-            summary = html.unescape(getattr(e, "summary", "") or "")
+            summary = html.unescape(e["summary"])
             items.append({
                 "title": title.strip(),
                 "link": link.strip(),
                 "source": urlparse(link).netloc,
+                "feed": url,
                 "summary": clean_text(summary),
                 "date": dt.isoformat() if dt else None,
             })
-    return items
+    return items, cache_updates
 
 # ---------- вытаскивание текста ----------
-def fetch_article_text(url: str) -> str:
+def fetch_article_text(url: str) -> Optional[str]:
+    """
+    Текст статьи. None — страницу не удалось скачать (сеть, не-200),
+    "" — скачали, но текста нет.
+    """
     try:
         html_doc = trafilatura.fetch_url(url, timeout=HTTP_TIMEOUT, no_ssl=True)
-        if not html_doc:
-            return ""
+    except Exception:
+        return None
+    if not html_doc:
+        return None
+    try:
         txt = trafilatura.extract(
             html_doc,
             include_comments=False,
             include_tables=False,
             favor_recall=True
         ) or ""
-        return clean_text(txt)
+        return clean_text(txt, has_html=False)
     except Exception:
         return ""
 
 # ---------- отбор AI-новостей ----------
-def filter_ai(items):
+# паузы выдерживаем только между запросами к одному и тому же хосту
+_host_locks = defaultdict(threading.Lock)
+_host_last = {}
+
+def polite_fetch_article_text(url: str) -> Optional[str]:
+    host = urlparse(url).netloc
+    with _host_locks[host]:
+        wait = _host_last.get(host, 0.0) + SLEEP_BETWEEN - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _host_last[host] = time.monotonic()
+    return fetch_article_text(url)
+
+def filter_ai(items, workers=PARALLEL_WORKERS_DEFAULT):
+    # по заголовку+описанию решаем, хватит ли просто текста или нужна перепроверка
+    by_basis = [is_ai_related((it["title"] + " " + it.get("summary","")).strip()) for it in items]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(polite_fetch_article_text, it["link"]): i for i, it in enumerate(items)}
+        for fut in as_completed(futures):
+            full = fut.result()
+            it = items[futures[fut]]
+            it["text"] = full or ""
+            it["fetch_failed"] = full is None
     out = []
-    for it in items:
-        basis = (it["title"] + " " + it.get("summary","")).strip()
-        if not is_ai_related(basis):
-            full = fetch_article_text(it["link"])
-            it["text"] = full
+    for it, ai_basis in zip(items, by_basis):
+        if not ai_basis:
+            full = it["text"]
             if not full or not is_ai_related((it["title"] + " " + full)):
+                # без текста из-за сбоя сети не знаем, AI ли это — ленту надо перечитать
+                it["retry"] = it["fetch_failed"]
                 continue
-        else:
-            it["text"] = fetch_article_text(it["link"])
         out.append(it)
-        time.sleep(SLEEP_BETWEEN)
     return out
 
 # ---------- дедуп ----------
 WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё0-9]{2,}", flags=re.UNICODE)
 
-def normalize_words(s: str):
-    return set(WORD_RE.findall(s.lower()))
+def token_hashes(s: str) -> np.ndarray:
+    # слова -> отсортированные уникальные 32-битные mmh3-хеши: 4 байта на токен вместо str в set
+    words = WORD_RE.findall(s.lower())
+    return np.unique(np.fromiter((mmh3.hash(w, signed=False) for w in words),
+                                 dtype=np.uint32, count=len(words)))
 
-def jaccard(a: set, b: set) -> float:
-    if not a or not b:
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    if not len(a) or not len(b):
         return 0.0
-    return len(a & b) / len(a | b)
+    inter = len(np.intersect1d(a, b, assume_unique=True))
+    return inter / (len(a) + len(b) - inter)
+
+def minhash(hashes: np.ndarray) -> MinHash:
+    # токены уже захешированы, MinHash остаётся только переставить значения
+    m = MinHash(num_perm=MINHASH_PERM, hashfunc=int)
+    m.update_batch(hashes)
+    return m
 
 def simple_dedup(items):
-    kept, sigs = [], []
-    for it in items:
+    # MinHash-LSH вместо попарного Жаккара: кандидаты ищутся за ~O(1) на элемент
+    lsh = MinHashLSH(threshold=SIMPLE_DUP_JACCARD, num_perm=MINHASH_PERM)
+    kept, sigs = [], {}
+    for i, it in enumerate(items):
         text_basis = (it["title"] + " " + (it.get("text") or it.get("summary","")))
-        sig = normalize_words(text_basis)
-        if any(jaccard(sig, sj) >= SIMPLE_DUP_JACCARD for sj in sigs):
+        sig = token_hashes(text_basis)
+        if not len(sig):
+            kept.append(it)
+            continue
+        m = minhash(sig)
+        # LSH даёт кандидатов с ложными срабатываниями — перепроверяем точным Жаккаром
+        if any(jaccard(sig, sigs[j]) >= SIMPLE_DUP_JACCARD for j in lsh.query(m)):
             continue
+        lsh.insert(i, m)
+        sigs[i] = sig
         kept.append(it)
-        sigs.append(sig)
     return kept
 
 # ---------- пары ----------
@@ -142,42 +369,47 @@ def to_triplets(items):
     """
     Возвращает список [текст, ссылка, дата].
     """
-    triples = []
-    for it in items:
-        title = it.get("title", "").strip()
-        summary = it.get("summary", "").strip()
-        full = it.get("text", "").strip()
+    M = MAX_TEXT_PER_ITEM
+    triples = [None] * len(items)
+    for i, it in enumerate(items):
+        get = it.get
+        title = get("title", "").strip()
+        summary = get("summary", "").strip()
         url = it["link"]
-        date = it.get("date")
 
         if title and summary:
-            text = f"{title} — {summary}"
+            text = title + " — " + summary
         elif title:
             text = title
-        elif full:
-            text = full[:MAX_TEXT_PER_ITEM]
         else:
-            text = url
+            text = get("text", "").strip()[:M] or url
 
-        if len(text) > MAX_TEXT_PER_ITEM:
-            text = text[:MAX_TEXT_PER_ITEM].rsplit(" ", 1)[0] + "…"
+        if len(text) > M:
+            text = text[:M].rsplit(" ", 1)[0] + "…"
 
-        triples.append([text, url, date])
+        triples[i] = [text, url, get("date")]
     return triples
 
 # ---------- main ----------
-def ai_news_process():
-    feeds, window = load_feeds()
-    raw = fetch_entries(feeds, window)
+def ai_news_process(feed_cache=None):
+    """
+    Возвращает (JSON-строка со списком триплетов, cache_updates).
+    cache_updates вызывающий сохраняет после того, как записал триплеты.
+    """
+    feeds, window, workers = load_feeds()
+    raw, cache_updates = fetch_entries(feeds, window, workers, cache=feed_cache)
     if not raw:
-        print("[]")
-        return
-    ai_items = filter_ai(raw)
+        return "[]", cache_updates
+    ai_items = filter_ai(raw, workers)
+    # лента, где отброшена статья из-за сбоя скачивания, остаётся со старым
+    # etag/modified — иначе следующий прогон получит 304 и статью не перепроверит
+    for it in raw:
+        if it.get("retry"):
+            cache_updates.pop(it["feed"], None)
     if not ai_items:
-        print("[]")
-        return
+        return "[]", cache_updates
     unique_items = simple_dedup(ai_items)
     triples = to_triplets(unique_items)
-    return json.dumps(triples, ensure_ascii=False, indent=2)
+    return orjson.dumps(triples, option=orjson.OPT_INDENT_2).decode("utf-8"), cache_updates
 
 